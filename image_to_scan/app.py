@@ -1,8 +1,13 @@
 import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from functools import partial
 from pathlib import Path
 from typing import List, Optional
 
+import cv2
 import typer
 
 from image_to_scan.core import convert_object, log
@@ -36,7 +41,6 @@ class ImageExtension(str, Enum):
     pbm = "pbm"
     pgm = "pgm"
     ppm = "ppm"
-    pxm = "pxm"
     pnm = "pnm"
     # PFM
     pfm = "pfm"
@@ -46,17 +50,31 @@ class ImageExtension(str, Enum):
     # TIFF
     tiff = "tiff"
     tif = "tif"
-    # OpenEXR Image
-    exr = "exr"
     # Radiance HDR
     hdr = "hdr"
     pic = "pic"
 
 
+def _init_worker(loglevel: int, opencl: bool):
+    # One OpenCV thread per process, otherwise every worker spins up its
+    # own thread pool and they fight over the same cores.
+    cv2.setNumThreads(1)
+    cv2.ocl.setUseOpenCL(opencl)
+    log.setLevel(loglevel)
+
+
+def _convert_file(file_path: Path, output_extension: str = "jpg",
+                  use_opencl: bool = False):
+    # Discard the returned image, no need to send it back to the parent
+    convert_object(file_path, new_file_extension=output_extension,
+                   use_opencl=use_opencl, as_rgb=False)
+
+
 @app.command()
 def main(files: Optional[List[Path]],
          loglevel: Loglevel = Loglevel.INFO,
-         output_extension: ImageExtension = ImageExtension.jpg):
+         output_extension: ImageExtension = ImageExtension.jpg,
+         opencl: bool = False):
     """
     Four Point Invoice Transform with OpenCV
 
@@ -65,10 +83,24 @@ def main(files: Optional[List[Path]],
     """
 
     log.setLevel(logging.getLevelName(loglevel.upper()))
+    cv2.ocl.setUseOpenCL(opencl)
+
+    # Debug mode opens preview windows, keep it sequential
+    if log.level == logging.DEBUG or len(files) <= 1:
+        for file_path in files:
+            _convert_file(file_path, output_extension.value, opencl)
+        return
 
-    for file_path in files:
-        convert_object(file_path)
+    with ProcessPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1),
+                             initializer=_init_worker,
+                             initargs=(log.level, opencl)) as executor:
+        list(executor.map(partial(_convert_file,
+                                  output_extension=output_extension.value,
+                                  use_opencl=opencl),
+                          files))
 
 
 if __name__ == "__main__":
+    # Frozen executables spawn pool workers by re-running themselves
+    multiprocessing.freeze_support()
     app()
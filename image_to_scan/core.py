@@ -1,6 +1,7 @@
 import logging
-from collections import namedtuple
-from operator import attrgetter
+import math
+import threading
+from functools import lru_cache
 
 import cv2
 import numpy as np
@@ -10,7 +11,27 @@ logging.basicConfig()
 log = logging.getLogger(__name__)
 
 
-Screen = namedtuple('Screen', ['fourpoints', 'width'])
+# Height in pixels of the image used to look for the document corners
+DETECTION_HEIGHT = 800
+# Contours smaller than this fraction of the image are considered noise
+MIN_SCREEN_AREA_RATIO = 0.01
+# Only the largest 4 point polygons are compared when picking the screen
+MAX_SCREEN_CANDIDATES = 2
+
+# Formats OpenCV refuses to encode from a single channel image
+_COLOR_ONLY_EXTENSIONS = (".ppm",)
+
+_thread_local = threading.local()
+
+
+def _clahe():
+    """CLAHE instance reused across calls, one per thread since
+    `apply` keeps internal state"""
+    clahe = getattr(_thread_local, "clahe", None)
+    if clahe is None:
+        clahe = cv2.createCLAHE(clipLimit=1.0, tileGridSize=(8, 8))
+        _thread_local.clahe = clahe
+    return clahe
 
 
 def previewImage(window_name: str,
@@ -35,7 +56,10 @@ def previewImage(window_name: str,
 
 def previewContours(image, contours, thickness=5):
     green = (0, 255, 0)
-    _image = image.copy()
+    if isinstance(image, cv2.UMat):
+        _image = image.get()
+    else:
+        _image = image.copy()
 
     _image = cv2.drawContours(_image, contours,
                               contourIdx=-1, color=green, thickness=thickness)
@@ -48,47 +72,79 @@ def order_points(pts):
     # such that the first entry in the list is the top-left,
     # the second entry is the top-right, the third is the
     # bottom-right, and the fourth is the bottom-left
-    rect = np.zeros((4, 2), dtype="float32")
+    x = pts[:, 0]
+    y = pts[:, 1]
 
     # the top-left point will have the smallest sum, whereas
     # the bottom-right point will have the largest sum
-    _sum = pts.sum(axis=1)
-    rect[0] = pts[np.argmin(_sum)]
-    rect[2] = pts[np.argmax(_sum)]
+    _sum = x + y
 
     # now, compute the difference between the points, the
     # top-right point will have the smallest difference,
     # whereas the bottom-left will have the largest difference
-    diff = np.diff(pts, axis=1)
-    rect[1] = pts[np.argmin(diff)]
-    rect[3] = pts[np.argmax(diff)]
+    diff = y - x
+
+    rect = pts[[_sum.argmin(), diff.argmin(), _sum.argmax(), diff.argmax()]]
 
     # return the ordered coordinates
-    return rect
+    return rect.astype("float32", copy=False)
+
+
+def build_warp_maps(rect, dst, size):
+    """Precomputes the `cv2.remap` maps for the perspective transform
+    taking `rect` to `dst`, with output `size` as (width, height)"""
+    transform_matrix = cv2.getPerspectiveTransform(rect, dst)
+    identity = np.eye(3, dtype=np.float32)
+    # With identity camera matrices the rectification map reduces to the
+    # inverse homography, i.e. the same lookup `warpPerspective` does
+    return cv2.initUndistortRectifyMap(identity, None, transform_matrix,
+                                       identity, size, cv2.CV_16SC2)
+
+
+# Maps for a large image take tens of MB, keep only a few around
+@lru_cache(maxsize=2)
+def _cached_warp_maps(rect_key, size):
+    rect = np.array(rect_key, dtype="float32").reshape(4, 2)
+    (width, height) = size
+    dst = np.array(
+        [[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]],
+        dtype="float32",
+    )
+    return build_warp_maps(rect, dst, size)
 
 
-def transform_to_four_points(image, pts):
-    """Apply the four point tranform to obtain a "birds eye view" of the image """
+def transform_to_four_points(image, pts, reuse_maps=False):
+    """Apply the four point tranform to obtain a "birds eye view" of the image
+
+    With `reuse_maps` the remap tables are cached by the exact corner
+    coordinates and output size. Only worth it when the caller warps many
+    same-shape images with the same fixed corners, building the tables
+    costs more than a single warp. Corners are not rounded for the cache
+    key, so the result matches the uncached warp.
+    """
 
     # obtain a consistent order of the points and unpack them
     # individually
     rect = order_points(pts)
+    log.debug("Ordered corners %s", rect)
 
-    (tl, tr, br, bl) = rect
+    # plain python floats, avoids numpy scalar overhead below
+    (tl, tr, br, bl) = rect.tolist()
 
     # compute the width of the new image, which will be the
     # maximum distance between bottom-right and bottom-left
-    # x-coordiates or the top-right and top-left x-coordinates
-    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-    maxWidth = max(int(widthA), int(widthB))
+    # x-coordiates or the top-right and top-left x-coordinates,
+    # comparing squared distances leaves a single square root
+    widthA = ((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2)
+    widthB = ((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2)
+    maxWidth = int(math.sqrt(max(widthA, widthB)))
 
     # compute the height of the new image, which will be the
     # maximum distance between the top-right and bottom-right
     # y-coordinates or the top-left and bottom-left y-coordinates
-    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-    maxHeight = max(int(heightA), int(heightB))
+    heightA = ((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2)
+    heightB = ((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2)
+    maxHeight = int(math.sqrt(max(heightA, heightB)))
 
     # now that we have the dimensions of the new image, construct
     # the set of destination points to obtain a "birds eye view",
@@ -105,6 +161,11 @@ def transform_to_four_points(image, pts):
         dtype="float32",
     )
 
+    if reuse_maps:
+        rect_key = tuple(rect.ravel().tolist())
+        map1, map2 = _cached_warp_maps(rect_key, (maxWidth, maxHeight))
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
+
     # compute the perspective transform matrix and then apply it
     transform_matrix = cv2.getPerspectiveTransform(rect, dst)
     warped = cv2.warpPerspective(image, transform_matrix, (maxWidth, maxHeight))
@@ -113,19 +174,79 @@ def transform_to_four_points(image, pts):
     return warped
 
 
-def convert_object(file_path, screen_size=None, new_file_suffix="scanned"):
-    """ Identifies 4 corners and does four point transformation """
-    debug = True if log.level == logging.DEBUG else False
-    image = cv2.imread(str(file_path))
+def _log_write_error(future):
+    if future.exception() is not None:
+        log.error("Could not write image: %s", future.exception())
+
+
+def save_image(image, file_path, writer=None):
+    """Encodes `image` in the format given by the `file_path` extension
+    and writes it to disk.
+
+    When a `writer` executor is given the write is submitted to it and
+    its future returned, so encoding the next image overlaps the disk IO.
+    """
+    if file_path.suffix.lower() in _COLOR_ONLY_EXTENSIONS and image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+    ok, buffer = cv2.imencode(file_path.suffix, image)
+    if not ok:
+        raise ValueError(f"Could not encode image as {file_path.suffix}")
+
+    if writer is None:
+        buffer.tofile(str(file_path))
+        return None
+
+    future = writer.submit(buffer.tofile, str(file_path))
+    future.add_done_callback(_log_write_error)
+    return future
+
+
+def convert_object(file_path, screen_size=None, new_file_suffix="scanned",
+                   use_opencl=False, as_rgb=True, new_file_extension="jpg",
+                   writer=None):
+    """ Identifies 4 corners and does four point transformation
+
+    With `use_opencl` the image processing runs on `cv2.UMat`, letting
+    OpenCV offload it to an OpenCL device when one is available and
+    `cv2.ocl.useOpenCL()` is enabled, which is left to the caller.
+    The scanned image is returned as RGB, or as a single channel
+    grayscale image when `as_rgb` is False.
+
+    With a `writer` executor the output file is written in the background
+    through `save_image`. Its future is not returned, a failed write is
+    only logged; callers that need to handle write errors should pass
+    no `writer` and call `save_image` on the result themselves.
+    """
+    # previews need a GUI, only show them when this logger itself was
+    # set to DEBUG (as the CLI does), not when inherited from the root
+    debug = log.level == logging.DEBUG
+    # decoding from memory also copes with non ascii paths on windows
+    buffer = np.fromfile(str(file_path), dtype=np.uint8)
+    image = cv2.imdecode(buffer, cv2.IMREAD_COLOR) if buffer.size else None
+    if image is None:
+        raise ValueError(f"Could not read image {file_path}")
+    (height, width) = image.shape[:2]
+
+    if use_opencl:
+        image = cv2.UMat(image)
+
+    # corners are found on a downscaled copy, only the final warp
+    # needs the full resolution image
+    scale = min(1.0, DETECTION_HEIGHT / height)
+    if scale < 1.0:
+        small = cv2.resize(image, None, fx=scale, fy=scale,
+                           interpolation=cv2.INTER_AREA)
+    else:
+        small = image
 
     # convert the image to grayscale, blur it, and find edges
     # in the image
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    gray = cv2.bilateralFilter(
-        gray, 11, 17, 17
-    )  # 11  //TODO 11 FRO OFFLINE MAY NEED TO TUNE TO 5 FOR ONLINE
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    # smooth while keeping edges, on the downscaled image a 7px
+    # neighbourhood is enough and much cheaper than 11px
+    gray = cv2.bilateralFilter(gray, 7, 17, 17)
 
-    gray = cv2.medianBlur(gray, 5)
     edged = cv2.Canny(gray, 30, 400)
 
     if debug:
@@ -133,45 +254,76 @@ def convert_object(file_path, screen_size=None, new_file_suffix="scanned"):
 
     # find contours in the edged image, keep only the largest
     # ones, and initialize our screen contour
+    if use_opencl:
+        # contour tracing only runs on the CPU
+        edged = edged.get()
+
+    # only trace inside the bounding box of the edges, with a 1px margin
+    # so edges on the box border are not treated as image border
+    (x, y, box_width, box_height) = cv2.boundingRect(edged)
+    x0, y0 = max(x - 1, 0), max(y - 1, 0)
+    x1 = min(x + box_width + 1, edged.shape[1])
+    y1 = min(y + box_height + 1, edged.shape[0])
 
     contours, hierarcy = cv2.findContours(
-        edged, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE
+        edged[y0:y1, x0:x1], cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE,
+        offset=(x0, y0)
     )
 
     log.debug("Contours found: %s", len(contours))
 
 
-    # approximate the contour
-    ContourArea = namedtuple('ContourArea', ['curve', 'area'])
-    contourAreas = [ContourArea(curve=x, area=cv2.contourArea(x))
-                    for x in contours]
-    contourAreas = sorted(contourAreas, key=attrgetter('area'))
+    # visit contours from largest to smallest area, dropping the ones
+    # too small to be a document, contours with less than 4 points
+    # can't be one either and skip the area computation
+    min_area = MIN_SCREEN_AREA_RATIO * height * width * scale ** 2
+    areas = np.fromiter((cv2.contourArea(x) if len(x) >= 4 else 0.0
+                         for x in contours),
+                        dtype=np.float64, count=len(contours))
+    contours = [contours[i] for i in np.argsort(-areas, kind="stable")
+                if areas[i] >= min_area]
 
     if debug:
-        previewContours(image, [x.curve for x in contourAreas])
-
-    screens = []  # 4 point polygons, repressenting possible screens (rectangles)
-    for contour in contourAreas:
-        peri = cv2.arcLength(contour.curve, True)
-        polygon_less_vertices = cv2.approxPolyDP(contour.curve,
+        previewContours(small, contours)
+
+    # 4 point polygons, repressenting possible screens (rectangles)
+    screens = np.empty((MAX_SCREEN_CANDIDATES, 4, 2), dtype=np.int32)
+    widths = np.empty(MAX_SCREEN_CANDIDATES, dtype=np.int32)
+    num_screens = 0
+    for contour in contours:
+        # approximate the contour
+        peri = cv2.arcLength(contour, True)
+        polygon_less_vertices = cv2.approxPolyDP(contour,
                                                  epsilon=0.02 * peri,  # approximation accuracy
                                                  closed=True)
 
         num_vertices = len(polygon_less_vertices)
         if num_vertices == 4:
-            (x, y, width, height) = cv2.boundingRect(contour.curve)
-            log.debug(f'x={x} y={y} width={width} height={height}')
-            screens.append(Screen(fourpoints=polygon_less_vertices, width=width))
+            screens[num_screens] = polygon_less_vertices.reshape(4, 2)
+            # horizontal extent of the polygon, as boundingRect would
+            widths[num_screens] = np.ptp(screens[num_screens, :, 0]) + 1
+            log.debug('screen=%s width=%s',
+                      screens[num_screens], widths[num_screens])
+            num_screens += 1
+            # largest candidates come first, no need to look any further
+            if num_screens >= MAX_SCREEN_CANDIDATES:
+                break
+
+    screens = screens[:num_screens]
+    widths = widths[:num_screens]
 
     if debug:
-        log.debug(f"Screens found {len(screens)}: {screens}")
-        previewContours(image, [x.fourpoints for x in screens])
+        log.debug("Screens found %s", num_screens)
+        previewContours(small, list(screens.reshape(-1, 4, 1, 2)))
+
+    if not num_screens:
+        raise ValueError(f"No document found in {file_path}")
 
     # find largest screen
-    largest_screen = max(screens, key=attrgetter('width'))
+    largest_screen = screens[widths.argmax()]
 
     if debug:
-        previewContours(image, [largest_screen.fourpoints])
+        previewContours(small, [largest_screen.reshape(4, 1, 2)])
 
     # now that we have our screen contour, we need to determine
     # the top-left, top-right, bottom-right, and bottom-left
@@ -179,10 +331,8 @@ def convert_object(file_path, screen_size=None, new_file_suffix="scanned"):
     # by reshaping our contour to be our finals and initializing
     # our output rectangle in top-left, top-right, bottom-right,
     # and bottom-left order
-    pts = largest_screen.fourpoints.reshape(4, 2)
+    pts = largest_screen / scale
     log.debug("Found bill rectagle at %s", pts)
-    rect = order_points(pts)
-    log.debug(rect)
 
     warped = transform_to_four_points(image, pts)
 
@@ -192,21 +342,25 @@ def convert_object(file_path, screen_size=None, new_file_suffix="scanned"):
     warp = cv2.cvtColor(warped, cv2.COLOR_BGR2GRAY)
     # Replacement for `skimage.exposure.rescale_intensity`
     # Contrast Limited Adaptive Histogram Equalization
-    clahe = cv2.createCLAHE(clipLimit=1.0, tileGridSize=(8, 8))
-    warp = clahe.apply(warp)
+    warp = _clahe().apply(warp)
+
+    if use_opencl:
+        warp = warp.get()
 
     # show the original and warped images
     if debug:
         previewImage("Original", image)
         previewImage("warp", warp)
 
-    warp_file = str(file_path.parent / f"{file_path.stem}-{new_file_suffix}.jpg")
-    cv2.imwrite(warp_file, warp)
-    log.debug(f"Result: {warp_file}")
+    warp_file = file_path.parent / \
+        f"{file_path.stem}-{new_file_suffix}.{new_file_extension}"
+    save_image(warp, warp_file, writer=writer)
+    log.debug("Result: %s", warp_file)
 
     if screen_size:
-        return cv2.cvtColor(
-            cv2.resize(warp, screen_size), cv2.COLOR_GRAY2RGB
-        )
-    else:
+        warp = cv2.resize(warp, screen_size)
+
+    if as_rgb:
         return cv2.cvtColor(warp, cv2.COLOR_GRAY2RGB)
+    else:
+        return warp
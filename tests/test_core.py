@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import cv2
+import numpy as np
+import pytest
+
 import image_to_scan
+from image_to_scan.app import ImageExtension, Loglevel, main
+from image_to_scan.core import _cached_warp_maps, transform_to_four_points
 
 
 class TestMiscellanea:
@@ -10,6 +18,71 @@ class TestMiscellanea:
         assert image_to_scan is not None
 
 
+class TestTransform:
+    def setup_method(self, method):
+        self.image = cv2.imread("tests/samples/02/original.jpg")
+        _cached_warp_maps.cache_clear()
+
+    def test_reuse_maps_matches_warp(self):
+        pts = np.array([[40, 60], [600, 50], [620, 800], [30, 780]])
+        warped = transform_to_four_points(self.image, pts)
+        remapped = transform_to_four_points(self.image, pts, reuse_maps=True)
+        assert np.array_equal(warped, remapped)
+
+    def test_reuse_maps_fractional_corners_not_rounded(self):
+        pts = np.array([[40.3, 60.7], [600.5, 50.2],
+                        [620.9, 800.1], [30.4, 780.6]])
+        warped = transform_to_four_points(self.image, pts)
+        remapped = transform_to_four_points(self.image, pts, reuse_maps=True)
+        assert np.array_equal(warped, remapped)
+
+    def test_reuse_maps_hits_cache(self):
+        pts = np.array([[40, 60], [600, 50], [620, 800], [30, 780]])
+        transform_to_four_points(self.image, pts, reuse_maps=True)
+        transform_to_four_points(self.image, pts, reuse_maps=True)
+        cache_info = _cached_warp_maps.cache_info()
+        assert cache_info.misses == 1
+        assert cache_info.hits == 1
+
+
+class TestReadErrors:
+    def test_not_an_image(self, tmp_path):
+        file_path = tmp_path / "text.jpg"
+        file_path.write_text("not an image")
+        with pytest.raises(ValueError, match="Could not read image"):
+            image_to_scan.convert_object(file_path)
+
+    def test_empty_file(self, tmp_path):
+        file_path = tmp_path / "empty.jpg"
+        file_path.touch()
+        with pytest.raises(ValueError, match="Could not read image"):
+            image_to_scan.convert_object(file_path)
+
+
+class TestApp:
+    def test_main_multiple_files(self, tmp_path):
+        files = []
+        for sample in ("02", "03"):
+            file_path = tmp_path / f"{sample}.jpg"
+            shutil.copy(f"tests/samples/{sample}/original.jpg", file_path)
+            files.append(file_path)
+
+        main(files, loglevel=Loglevel.INFO,
+             output_extension=ImageExtension.jpg, opencl=False)
+
+        for file_path in files:
+            assert (tmp_path / f"{file_path.stem}-scanned.jpg").exists()
+
+    def test_main_every_output_extension(self, tmp_path):
+        file_path = tmp_path / "02.jpg"
+        shutil.copy("tests/samples/02/original.jpg", file_path)
+
+        for extension in ImageExtension:
+            main([file_path], loglevel=Loglevel.INFO,
+                 output_extension=extension, opencl=False)
+            assert (tmp_path / f"02-scanned.{extension.value}").exists()
+
+
 class TestSamples:
     def teardown_method(self, method):
         os.remove(self.output_file)
@@ -21,3 +94,29 @@ class TestSamples:
         self.output_file = input_file.parent / f"{input_file.stem}-{suffix}.{extension}"
         image_to_scan.convert_object(input_file, new_file_suffix=f"{suffix}")
         assert self.output_file.exists()
+
+    def test_sample_02_opencl(self):
+        input_file = Path("tests/samples/02/original.jpg")
+        suffix = "warped"
+        extension = "jpg"
+        self.output_file = input_file.parent / f"{input_file.stem}-{suffix}.{extension}"
+        expected = image_to_scan.convert_object(input_file,
+                                                new_file_suffix=f"{suffix}")
+        scanned = image_to_scan.convert_object(input_file,
+                                               new_file_suffix=f"{suffix}",
+                                               use_opencl=True)
+        assert self.output_file.exists()
+        assert scanned.shape == expected.shape
+        assert np.mean(cv2.absdiff(scanned, expected)) < 1
+
+    def test_sample_02_background_write(self):
+        input_file = Path("tests/samples/02/original.jpg")
+        suffix = "warped"
+        extension = "png"
+        self.output_file = input_file.parent / f"{input_file.stem}-{suffix}.{extension}"
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            image_to_scan.convert_object(input_file,
+                                         new_file_suffix=f"{suffix}",
+                                         new_file_extension=extension,
+                                         writer=writer)
+        assert self.output_file.exists()